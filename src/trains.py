@@ -2,10 +2,100 @@ import requests
 import uuid
 import json
 import re
-from datetime import datetime
+import time
+from bisect import insort
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Optional speed-up: orjson parses the raw response bytes directly and is much
+# faster than the stdlib. It is not in requirements.txt as there is no wheel
+# for every device type, so fall back to json (both accept bytes).
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# --- HTTP SESSION ---
+
+# Headers that never change between requests, built once at import
+_BASE_HEADERS = {
+    'authority': 'app.uz.gov.ua',
+    'accept': 'application/json',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'x-client-locale': 'en',
+    'x-user-agent': 'UZ/2 Web/1 User/guest'
+}
+
+# One shared session so the TCP/TLS connection to the UZ API is kept alive
+# and reused between polls instead of being re-negotiated every refresh.
+_SESSION = requests.Session()
+_SESSION.headers.update(_BASE_HEADERS)
+
+# Requests run on the render thread, so keep the connect timeout short
+_CONNECT_TIMEOUT = 3
+_READ_TIMEOUT = 10
+
+# Retry transient failures with backoff on the kept-alive connection instead
+# of failing the whole refresh; the final response is still returned as-is.
+# Read timeouts are not retried and Retry-After is ignored (only the backoff
+# applies), so a refresh on the render thread is bounded by a few timeouts.
+_RETRY = Retry(
+    total=2,
+    connect=2,
+    read=0,
+    status=1,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['GET']),
+    raise_on_status=False,
+    respect_retry_after_header=False
+)
+
+# Connection pool size also caps how many stations are fetched in parallel
+_POOL_MAXSIZE = 10
+_SESSION.mount('https://', HTTPAdapter(max_retries=_RETRY, pool_connections=4, pool_maxsize=_POOL_MAXSIZE))
+
+
+def get_session():
+    """
+    Returns the shared requests.Session used for all UZ API calls.
+    """
+    return _SESSION
 
 # --- HELPER FUNCTIONS ---
 
+# Matches anything that is NOT a digit, used to clean up train numbers
+_NON_DIGIT = re.compile(r'\D')
+
+# Normalises route strings in one pass: non-breaking spaces and arrows
+_ROUTE_TRANS = str.maketrans({'\xa0': ' ', '\u2192': '->'})
+
+# Route separators in order of preference
+_ROUTE_DELIMITERS = (' - ', '->')
+
+def _board_utc_offset(raw_departures):
+    """
+    Returns the local UTC offset (in seconds) if it is the same for the
+    earliest and latest departure on the board, otherwise None so the caller
+    can look up the offset per departure.
+    """
+    timestamps = [
+        timestamp for timestamp in (item.get('time') for item in raw_departures)
+        if timestamp and isinstance(timestamp, (int, float))
+    ]
+    if not timestamps:
+        return None
+
+    try:
+        first = time.localtime(int(min(timestamps))).tm_gmtoff
+        last = time.localtime(int(max(timestamps))).tm_gmtoff
+    except (ValueError, OverflowError, OSError):
+        return None
+
+    return first if first == last else None
+
 def joinWithSpaces(*args):
     """
     Helper to join strings with spaces, filtering out empty ones.
@@ -15,50 +105,69 @@ def joinWithSpaces(*args):
 
 # --- API CONNECTION ---
 
-def get_uz_board(station_id):
-    """
-    Connects to the UZ API to get the raw departure board.
-    
-    Checks added: Proper status code handling, request timeout, and general exceptions.
+# Last board per station, kept so it can be revalidated with a conditional
+# request; station_id -> (fetched_at, payload, validators)
+_CACHE = {}
+
+# Oldest cached board (in seconds) that may be shown when a fetch fails
+_MAX_STALE_AGE = 600
+
+
+def _fetch_uz_board(station_id):
     """
-    # 🚅 Input validation for station_id
-    if not isinstance(station_id, str) or not station_id.isdigit():
-        print(f"Validation Error: Invalid station ID provided: {station_id}")
-        return None
+    Performs the actual HTTP request for a station board and updates the cache.
 
+    Sends If-None-Match / If-Modified-Since when the cache holds validators,
+    so an unchanged board comes back as a cheap 304.
+    """
     url = f"https://app.uz.gov.ua/api/station-boards/{station_id}"
     
     # 💡 Generate a new UUID for each session attempt
     session_id = str(uuid.uuid4())
     
-    headers = {
-        'authority': 'app.uz.gov.ua',
-        'accept': 'application/json',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'x-client-locale': 'en',
-        'x-session-id': session_id,
-        'x-user-agent': 'UZ/2 Web/1 User/guest'
-    }
+    # Static headers live on the shared session; only the session id varies
+    headers = {'x-session-id': session_id}
+
+    cached = _CACHE.get(station_id)
+    if cached:
+        headers.update(cached[2])
 
     try:
-        # Use a short, strict timeout (10 seconds)
-        response = requests.get(url, headers=headers, timeout=10)
+        # Use a short, strict timeout (3s to connect, 10s to read)
+        response = get_session().get(url, headers=headers, timeout=(_CONNECT_TIMEOUT, _READ_TIMEOUT))
+
+        # 304: Board unchanged, extend the life of the cached copy
+        if response.status_code == 304 and cached:
+            _CACHE[station_id] = (time.monotonic(), cached[1], cached[2])
+            return cached[1]
         
         # 200: Success
         if response.status_code == 200:
             # 🔍 Check if the content is truly JSON
+            # The body is parsed in one go rather than streamed: boards are a
+            # few KB and the parsed dict is what the cache keeps anyway.
+            # ValueError covers both parsers' decode errors and undecodable bytes
             try:
-                return response.json()
-            except json.JSONDecodeError:
+                payload = _json_loads(response.content)
+            except ValueError:
                 print("UZ API Error: Received 200 but response is not valid JSON.")
                 return None
+
+            validators = {}
+            if response.headers.get('ETag'):
+                validators['If-None-Match'] = response.headers['ETag']
+            if response.headers.get('Last-Modified'):
+                validators['If-Modified-Since'] = response.headers['Last-Modified']
+
+            _CACHE[station_id] = (time.monotonic(), payload, validators)
+            return payload
         
         # 400s/500s: Server or client error
         print(f"UZ API Error: Received status code {response.status_code}")
         return None
             
     except requests.exceptions.Timeout:
-        print("Connection Error: Request timed out after 10 seconds.")
+        print("Connection Error: Request timed out.")
         return None
     except requests.exceptions.RequestException as e:
         print(f"Connection Error: A network error occurred: {e}")
@@ -67,14 +176,36 @@ def get_uz_board(station_id):
         print(f"Connection Error: An unexpected error occurred: {e}")
         return None
 
+
+def get_uz_board(station_id):
+    """
+    Connects to the UZ API to get the raw departure board.
+    
+    Checks added: Proper status code handling, request timeout, and general exceptions.
+    Unchanged boards are revalidated against the last cached copy.
+    """
+    # 🚅 Input validation for station_id
+    if not isinstance(station_id, str) or not station_id.isdigit():
+        print(f"Validation Error: Invalid station ID provided: {station_id}")
+        return None
+
+    cached = _CACHE.get(station_id)
+    json_data = _fetch_uz_board(station_id)
+    if json_data is None and cached and time.monotonic() - cached[0] < _MAX_STALE_AGE:
+        # 🛡️ Better a slightly out-of-date board than a blank one
+        print("UZ API Error: Serving last known board for this station.")
+        return cached[1]
+    return json_data
+
 # --- DATA TRANSFORMATION ---
 
-def process_uz_data(json_data, journeyConfig):
+def process_uz_data(json_data, journeyConfig, limit=None):
     """
     Converts UZ JSON format into the specific dictionary format 
     expected by the UK Train Display 'main.py'.
     
     Checks added: Robust dictionary key access and destination name fallback.
+    If limit is given, only the earliest 'limit' departures are built.
     """
     if not json_data:
         # 🛑 Handle cases where API connection failed or returned empty data
@@ -89,87 +220,105 @@ def process_uz_data(json_data, journeyConfig):
         print("Data Error: 'departures' field is not a list.")
         return [], station_name
         
-    processed_services = []
+    # (minutes-of-day, arrival index, departure) so sorting compares plain
+    # ints; the index keeps the sort stable and never falls through to the dicts
+    keyed_services = []
 
-    for item in raw_departures:
-        departure = {}
+    # Local UTC offset shared by every departure on the board, so times can be
+    # formatted with integer maths; None if the board spans a DST change
+    utc_offset = _board_utc_offset(raw_departures)
 
+    # Bind the bound method once so the loop avoids repeated attribute lookups
+    strip_non_digits = _NON_DIGIT.sub
+
+    for index, item in enumerate(raw_departures):
         # --- A. TIME ---
         timestamp = item.get('time')
         if timestamp and isinstance(timestamp, (int, float)):
             try:
-                dt = datetime.fromtimestamp(timestamp)
-                departure["aimed_departure_time"] = dt.strftime("%H:%M")
-            except ValueError:
-                departure["aimed_departure_time"] = "Bad Time" # Handle invalid timestamp value
+                offset = utc_offset
+                if offset is None:
+                    offset = time.localtime(int(timestamp)).tm_gmtoff
+                minutes = ((int(timestamp) + offset) // 60) % 1440
+                aimed = f"{minutes // 60:02d}:{minutes % 60:02d}"
+            except (ValueError, OverflowError, OSError):
+                minutes = 1440 # Bad times sort last
+                aimed = "Bad Time" # Handle invalid timestamp value
         else:
-            departure["aimed_departure_time"] = "--:--"
+            minutes = -1 # Missing times sort first
+            aimed = "--:--"
+
+        # ✂️ Skip rows that would sort after an already full board
+        if limit is not None and len(keyed_services) >= limit:
+            if not keyed_services or minutes >= keyed_services[-1][0]:
+                continue
 
         # --- B. STATUS ---
         delay = item.get('delay_minutes')
         if isinstance(delay, (int, float)) and delay > 0:
             # Use int() to ensure clean minutes display
-            departure["expected_departure_time"] = f"Late {int(delay)}m"
+            expected = f"Late {int(delay)}m"
         else:
-            departure["expected_departure_time"] = "On time"
+            expected = "On time"
 
         # --- C. DESTINATION ---
         # 🎯 Improved: Prioritize the destination name from the 'destination' object if available
-        destination_name = item.get('destination', {}).get('name')
-        route = item.get('route', '')
+        destination = item.get('destination', {}).get('name')
+        # 🌟 Clean the route string in a single translate pass
+        route = item.get('route', '').translate(_ROUTE_TRANS).strip()
         
-        # 🌟 MINIMAL CHANGE: CLEAN THE ROUTE STRING HERE
-        route = route.replace('\xa0', ' ').replace(u'\u2192', '->').strip()
-        
-        if destination_name:
-             departure["destination_name"] = destination_name
-        elif route:
+        if not destination and route:
             # Fallback to parsing the route string if 'destination' object is missing
-            if ' - ' in route:
-                departure["destination_name"] = route.split(' - ')[-1].strip()
-            # The 'u\u2192' handling below is now redundant since we replaced it with '->' above,
-            # but leaving the original parsing logic for '->' for robustness.
-            elif '->' in route:
-                departure["destination_name"] = route.split('->')[-1].strip()
-            else:
-                departure["destination_name"] = route.strip() # Use the whole route as fallback
-        else:
-            departure["destination_name"] = "Destination Unknown"
+            # Last segment after the first separator found; whole route otherwise
+            destination = route
+            for delimiter in _ROUTE_DELIMITERS:
+                _, sep, tail = route.rpartition(delimiter)
+                if sep:
+                    destination = tail.strip()
+                    break
+        elif not destination:
+            destination = "Destination Unknown"
 
         # --- D. PLATFORM ---
         plat = item.get('platform')
         # Ensure platform is not None before converting to string
-        departure["platform"] = str(plat) if plat is not None else "" 
+        platform = str(plat) if plat is not None else "" 
 
-        # --- E. CARRIAGES / OPERATOR (Standard values) ---
-        departure["carriages"] = 0
-        departure["operator"] = "UZ"
-
-        # --- F. TRAIN NUMBER CLEANUP ---
+        # --- E. TRAIN NUMBER CLEANUP ---
         raw_train_num = str(item.get('train', ''))
-        # Regex: \D means "anything that is NOT a digit". 
-        train_num = re.sub(r'\D', '', raw_train_num)
+        # Strip everything that is not a digit (pattern precompiled above)
+        train_num = strip_non_digits('', raw_train_num)
         
         # Fallback to raw number if cleanup results in an empty string
         if not train_num:
             train_num = raw_train_num if raw_train_num else "N/A"
 
-        # --- G. CALLING POINTS ---
-        departure["calling_at_list"] = joinWithSpaces(
-            f"Train {train_num} to {departure['destination_name']}.",
-            f"Route: {route}." if route else None, # Include route only if it exists
-            "Ukrainian Railways."
+        # --- F. CALLING POINTS ---
+        # Built inline rather than via joinWithSpaces; include route only if it exists
+        calling_at = (
+            f"Train {train_num} to {destination}."
+            + (f" Route: {route}." if route else "")
+            + " Ukrainian Railways."
         )
 
-        processed_services.append(departure)
+        # --- G. BUILD ROW (carriages / operator are standard values) ---
+        departure = {
+            "aimed_departure_time": aimed,
+            "expected_departure_time": expected,
+            "destination_name": destination,
+            "platform": platform,
+            "carriages": 0,
+            "operator": "UZ",
+            "calling_at_list": calling_at,
+        }
 
-    # Sort by time
-    try:
-        processed_services.sort(key=lambda x: x["aimed_departure_time"])
-    except TypeError:
-        # 🛡️ Handle case where time is "Bad Time" or "--:--" and cannot be sorted
-        print("Sorting Error: Could not sort services by time.")
-        pass
+        # Boards arrive roughly in time order, so insert in place rather than
+        # sorting in a second pass
+        insort(keyed_services, (minutes, index, departure))
+        if limit is not None and len(keyed_services) > limit:
+            keyed_services.pop()
+
+    processed_services = [departure for _, _, departure in keyed_services]
 
     return processed_services, station_name
 # --- MAIN ENTRY POINT ---
@@ -189,15 +338,31 @@ def loadDeparturesForStation(journeyConfig, apiKey, rows):
         print("Config Error: 'departureStation' key is missing or empty in config.")
         return [], "Config Error"
 
-    json_data = get_uz_board(station_id)
-    departures, station_name = process_uz_data(json_data, journeyConfig)
-
-    # ✂️ Slice the list to return only the requested number of rows
+    # ✂️ Only build the requested number of rows
     # Ensure 'rows' is treated as an integer and defaults to a reasonable number
     try:
-        limit = int(rows)
+        limit = max(int(rows), 0)
     except (TypeError, ValueError):
         limit = 10 # Default to 10 rows if 'rows' argument is bad
 
-    # Only return up to the specified number of rows
-    return departures[:limit], station_name
+    json_data = get_uz_board(station_id)
+    return process_uz_data(json_data, journeyConfig, limit)
+
+
+def loadDeparturesForStations(journeyConfigs, apiKey, rows):
+    """
+    Loads several station boards concurrently over the shared session.
+
+    Returns a list of (departures, station_name) tuples in the same order
+    as journeyConfigs.
+    """
+    if not journeyConfigs:
+        return []
+
+    # Fetching is network-bound, so threads overlap the requests
+    workers = min(len(journeyConfigs), _POOL_MAXSIZE)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda journeyConfig: loadDeparturesForStation(journeyConfig, apiKey, rows),
+            journeyConfigs
+        ))